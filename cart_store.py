@@ -0,0 +1,216 @@
+from asyncio import CancelledError, Lock, create_task, sleep, to_thread
+from logging import getLogger
+from os import fsync, path, remove, replace
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, insert, select, tuple_
+
+logger = getLogger(__name__)
+
+class CartStore:
+    """Write-behind cache for the ``cart`` table.
+
+    Carts live in memory as ``{user_id: {product_id: quantity}}`` and are loaded from
+    the database on first use. Changed (user_id, product_id) pairs are coalesced and
+    written every ``interval`` seconds, ``chunk`` pairs per transaction, and once more
+    on ``stop()``. A failing chunk stays pending without holding back the others, and
+    repeated failures back off up to ``max_interval`` seconds.
+
+    With ``journal`` set, ``add`` and ``remove`` return only once their change is in the
+    journal file. Changes are group-committed: one writer thread appends (and with
+    ``fsync`` syncs) everything buffered so far, so concurrent changes share a disk
+    sync and the event loop never blocks on it. Each flush compacts the changes still
+    pending into ``<journal>.flushing`` and starts the journal afresh, and both files
+    are replayed into the database on ``start()``.
+    """
+
+    def __init__(self, session_factory, model, journal: Optional[str] = None,
+                 fsync: bool = False, interval: float = 1.0, max_interval: float = 60.0,
+                 idle: float = 600.0, chunk: int = 200):
+        self.session_factory = session_factory
+        self.model = model
+        self.journal = journal
+        self.fsync = fsync
+        self.chunk = chunk
+        self.interval = interval
+        self.max_interval = max_interval
+        self.idle = idle
+        self.carts: Dict[int, Dict[int, int]] = {}
+        self.seen: Dict[int, float] = {}
+        self.dirty: Dict[Tuple[int, int], int] = {}
+        self.failures = 0  # Flushes in a row with a failed chunk
+        self.journal_file = None
+        self.journal_lock = Lock()
+        self.buffer: List[str] = []
+        self.appended = 0  # Lines ever added to the buffer
+        self.written = 0  # Lines ever written to the journal
+        self.task = None
+
+    async def start(self):
+        if self.journal:
+            await self.replay()
+            self.journal_file = open(self.journal, "a")
+        self.task = create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except CancelledError:
+                pass
+        await self.flush()
+        if self.journal_file:
+            async with self.journal_lock:
+                self.journal_file.close()
+
+    async def run(self):
+        while True:
+            await sleep(min(self.interval * 2 ** self.failures, self.max_interval))
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Cart flush failed, will retry")
+
+    async def get(self, user_id: int) -> Dict[int, int]:
+        if user_id not in self.carts:
+            async with self.session_factory() as session:
+                rows = (await session.execute(
+                    select(self.model.product_id, self.model.quantity).where(self.model.user_id == user_id)
+                )).all()
+            # Another request may have loaded (and changed) the cart while we were waiting
+            self.carts.setdefault(user_id, {product_id: quantity for product_id, quantity in rows})
+        self.seen[user_id] = monotonic()
+        return self.carts[user_id]
+
+    async def add(self, user_id: int, product_id: int, quantity: int = 1):
+        cart = await self.get(user_id)
+        self.set(user_id, product_id, cart.get(product_id, 0) + quantity)
+        await self.sync()
+
+    async def remove(self, user_id: int, product_id: int, quantity: int = 1) -> bool:
+        cart = await self.get(user_id)
+        if product_id not in cart:
+            return False
+        self.set(user_id, product_id, max(cart[product_id] - quantity, 0))
+        await self.sync()
+        return True
+
+    def set(self, user_id: int, product_id: int, quantity: int):
+        if self.journal_file:
+            self.buffer.append(f"{user_id} {product_id} {quantity}\n")
+            self.appended += 1
+        if quantity:
+            self.carts[user_id][product_id] = quantity
+        else:
+            self.carts[user_id].pop(product_id, None)
+        self.dirty[(user_id, product_id)] = quantity
+
+    async def sync(self):
+        """Waits until every change made so far is in the journal."""
+        if not self.journal_file:
+            return
+        target = self.appended
+        async with self.journal_lock:
+            # A writer that held the lock before us may have written our lines too
+            if self.written >= target or not self.buffer:
+                return
+            lines, self.buffer = self.buffer, []
+            try:
+                await to_thread(self.append, "".join(lines))
+            except BaseException:
+                self.buffer = lines + self.buffer
+                raise
+            self.written += len(lines)
+
+    def append(self, text: str):
+        self.journal_file.write(text)
+        self.journal_file.flush()
+        if self.fsync:
+            fsync(self.journal_file.fileno())
+
+    def rotate(self, text: str):
+        with open(self.journal + ".flushing.tmp", "w") as file:
+            file.write(text)
+            file.flush()
+            if self.fsync:
+                fsync(file.fileno())
+        replace(self.journal + ".flushing.tmp", self.journal + ".flushing")
+        self.journal_file.close()
+        self.journal_file = open(self.journal, "w")
+
+    async def flush(self):
+        batch, self.dirty = self.dirty, {}
+        if batch:
+            if self.journal_file:
+                # Everything not yet in the database moves to a compact .flushing file;
+                # changes made while this batch is written go to the emptied journal
+                async with self.journal_lock:
+                    try:
+                        await to_thread(self.rotate, "".join(
+                            f"{user_id} {product_id} {quantity}\n" for (user_id, product_id), quantity in batch.items()
+                        ))
+                    except BaseException:
+                        self.dirty = {**batch, **self.dirty}
+                        raise
+            items, failed = list(batch.items()), 0
+            for start in range(0, len(items), self.chunk):
+                chunk = dict(items[start:start + self.chunk])
+                try:
+                    await self.write(chunk)
+                except Exception:
+                    if not self.failures:
+                        logger.exception("Failed to flush %d cart changes, will retry", len(chunk))
+                    self.dirty = {**chunk, **self.dirty}
+                    failed += len(chunk)
+                except BaseException:
+                    self.dirty = {**dict(items[start:]), **self.dirty}
+                    raise
+            if failed:
+                self.failures += 1
+                logger.warning("%d cart changes still pending after %d failed flushes", failed, self.failures)
+            else:
+                self.failures = 0
+                if self.journal_file:
+                    await to_thread(remove, self.journal + ".flushing")
+            logger.info("Flushed %d cart changes", len(batch) - failed)
+        self.evict()
+
+    async def write(self, batch: Dict[Tuple[int, int], int]):
+        async with self.session_factory() as session, session.begin():
+            await session.execute(
+                delete(self.model).where(tuple_(self.model.user_id, self.model.product_id).in_(list(batch)))
+            )
+            rows = [
+                {"user_id": user_id, "product_id": product_id, "quantity": quantity}
+                for (user_id, product_id), quantity in batch.items() if quantity
+            ]
+            if rows:
+                await session.execute(insert(self.model), rows)
+
+    async def replay(self):
+        batch = {}
+        for name in (self.journal + ".flushing", self.journal):
+            if path.exists(name):
+                with open(name) as file:
+                    for line in file:
+                        try:
+                            user_id, product_id, quantity = map(int, line.split())
+                        except ValueError:
+                            continue  # Torn last line after a crash
+                        batch[(user_id, product_id)] = quantity
+        items = list(batch.items())
+        for start in range(0, len(items), self.chunk):
+            await self.write(dict(items[start:start + self.chunk]))
+        if batch:
+            logger.info("Replayed %d cart changes from journal", len(batch))
+        for name in (self.journal + ".flushing.tmp", self.journal + ".flushing", self.journal):
+            if path.exists(name):
+                remove(name)
+
+    def evict(self):
+        expired = monotonic() - self.idle
+        pending = {user_id for user_id, _ in self.dirty}
+        for user_id in [user_id for user_id, seen in self.seen.items() if seen < expired and user_id not in pending]:
+            del self.carts[user_id], self.seen[user_id]
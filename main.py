@@ -7,19 +7,28 @@ from logging import basicConfig, INFO
 from simple_api import app
 from uvicorn import Server, Config
 
+from middlewares import SchedulerMiddleware, TimedEventIsolation
 from routes import start, admin
 
+config = dotenv_values(".env")
+HANDLERS_LIMIT = int(config.get("HANDLERS_LIMIT", "8"))
+UPDATES_LIMIT = int(config.get("UPDATES_LIMIT", "64"))
+
 bot = Bot(
-    token=dotenv_values(".env")["BOT_TOKEN"],
+    token=config["BOT_TOKEN"],
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
-dp = Dispatcher()
+# Updates from one chat are handled one at a time, and the FSM state is read only
+# after the previous update has finished, so double taps can't race on ItemForm
+dp = Dispatcher(events_isolation=TimedEventIsolation())
+dp.update.outer_middleware(SchedulerMiddleware(limit=HANDLERS_LIMIT))
 dp.include_routers(admin.router, start.router)
 
 async def main():
     basicConfig(level=INFO, format="[%(asctime)s] %(message)s")
     await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # Polling stops fetching while UPDATES_LIMIT updates are queued or running
+    await dp.start_polling(bot, tasks_concurrency_limit=UPDATES_LIMIT)
 
 if __name__ == "__main__":
     async_run(main())
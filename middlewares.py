@@ -0,0 +1,76 @@
+from asyncio import Semaphore
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from logging import getLogger
+from statistics import median
+from time import perf_counter
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import SimpleEventIsolation
+from aiogram.types import TelegramObject, Update
+
+logger = getLogger(__name__)
+
+# Time the current update spent waiting on its chat lock, set by TimedEventIsolation
+lock_wait: ContextVar[float] = ContextVar("lock_wait", default=0.0)
+
+class TimedEventIsolation(SimpleEventIsolation):
+    """Per-chat lock of the FSM middleware that records how long it was waited on."""
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        started_at = perf_counter()
+        async with super().lock(key):
+            lock_wait.set(perf_counter() - started_at)
+            yield
+
+class SchedulerMiddleware(BaseMiddleware):
+    """Caps the number of handlers running at once and reports their timing.
+
+    Register it as an outer middleware on ``dp.update`` of a Dispatcher built with
+    ``events_isolation=TimedEventIsolation()``, which serializes updates per chat before
+    the FSM state is loaded. The reported wait is the time spent on the chat lock plus
+    the time spent on a handler slot. Every update is logged at DEBUG, and a summary
+    is logged at INFO every ``report`` seconds.
+    """
+
+    def __init__(self, limit: int = 8, report: float = 60.0):
+        self.slots = Semaphore(limit)
+        self.report = report
+        self.waits: List[float] = []
+        self.handles: List[float] = []
+        self.reported_at = perf_counter()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        queued_at = perf_counter()
+        async with self.slots:
+            started_at = perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                finished_at = perf_counter()
+                self.record(event, lock_wait.get() + started_at - queued_at, finished_at - started_at)
+
+    def record(self, event: Update, wait: float, handle: float):
+        logger.debug(
+            "Update id=%s scheduled: waited %.0f ms, handled in %.0f ms",
+            event.update_id, wait * 1000, handle * 1000
+        )
+        self.waits.append(wait)
+        self.handles.append(handle)
+        if perf_counter() - self.reported_at >= self.report:
+            logger.info(
+                "Scheduled %d updates: wait p50 %.0f ms, max %.0f ms; handler p50 %.0f ms, max %.0f ms",
+                len(self.waits),
+                median(self.waits) * 1000, max(self.waits) * 1000,
+                median(self.handles) * 1000, max(self.handles) * 1000
+            )
+            self.waits, self.handles = [], []
+            self.reported_at = perf_counter()
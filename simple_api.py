@@ -13,6 +13,8 @@ from httpx import AsyncClient
 from datetime import datetime
 import json
 
+from cart_store import CartStore
+
 # Load config
 config = dotenv_values(".env")
 BOT_TOKEN = config["BOT_TOKEN"]
@@ -57,6 +59,17 @@ class Order(Base):
     total: Mapped[int]
     created_at: Mapped[datetime] = mapped_column(default=func.now())
 
+# Active carts are kept in memory and flushed to the cart table in batches;
+# set CART_JOURNAL to a file path to survive crashes between flushes, and
+# CART_JOURNAL_FSYNC=1 to also survive OS crashes. Journal writes are grouped
+# and done off the event loop, so concurrent cart changes share one disk sync
+cart_store = CartStore(
+    async_session, CartItem,
+    journal=config.get("CART_JOURNAL"),
+    fsync=config.get("CART_JOURNAL_FSYNC", "0") == "1",
+    interval=float(config.get("CART_FLUSH_INTERVAL", "1.0"))
+)
+
 # Pydantic Schemas
 class ProductIn(BaseModel):
     name: str
@@ -98,7 +111,9 @@ class OrderIn(BaseModel):
 async def lifespan(app: FastAPI):
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await cart_store.start()
     yield
+    await cart_store.stop()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -212,44 +227,30 @@ async def get_avatar(user_id: int):
 
 # CART FUNCTIONALITY
 @app.post("/add_to_cart/")
-async def add_to_cart(user_id: int, product_id: int, quantity: int = 1, session: AsyncSession = Depends(get_session)):
-    cart_item = (await session.execute(
-        select(CartItem).where(CartItem.user_id == user_id, CartItem.product_id == product_id)
-    )).scalar_one_or_none()
-
-    if cart_item:
-        cart_item.quantity += quantity
-    else:
-        cart_item = CartItem(user_id=user_id, product_id=product_id, quantity=quantity)
-        session.add(cart_item)
-
-    await session.commit()
+async def add_to_cart(user_id: int, product_id: int, quantity: int = 1):
+    await cart_store.add(user_id, product_id, quantity)
     return {"message": "Item added to cart"}
 
 @app.delete("/del_from_cart/")
-async def del_from_cart(user_id: int, product_id: int, quantity: int = 1, session: AsyncSession = Depends(get_session)):
-    cart_item = (await session.execute(
-        select(CartItem).where(CartItem.user_id == user_id, CartItem.product_id == product_id)
-    )).scalar_one_or_none()
-    if not cart_item:
+async def del_from_cart(user_id: int, product_id: int, quantity: int = 1):
+    if not await cart_store.remove(user_id, product_id, quantity):
         raise HTTPException(status_code=404, detail="Item not found in cart")
-    if cart_item.quantity > quantity:
-        cart_item.quantity -= quantity
-    else:
-        await session.delete(cart_item)
-    await session.commit()
     return {"message": "Item removed from cart"}
 
 @app.get("/get_cart/", response_model=List[CartProductOut])
 async def get_cart(user_id: int, session: AsyncSession = Depends(get_session)):
-    result = await session.execute(
-        select(Product, CartItem.quantity)
-        .join(CartItem, Product.id == CartItem.product_id)
-        .where(CartItem.user_id == user_id)
-    )
+    cart = dict(await cart_store.get(user_id))
+    if not cart:
+        return []
+    products = {product.id: product for product in (await session.execute(
+        select(Product).where(Product.id.in_(list(cart)))
+    )).scalars().all()}
     data = []
-    for product, quantity in result.all():
-        prod_dict = product.__dict__.copy()
+    # Items keep the order they were added to the cart in
+    for product_id, quantity in cart.items():
+        if product_id not in products:
+            continue
+        prod_dict = products[product_id].__dict__.copy()
         prod_dict['quantity'] = quantity
         data.append(prod_dict)
     return data